@@ -4,10 +4,11 @@
 # Date: 2021-04
 # Copyright (c) 2021 vslg & contributors
 
+import logging
 import random
 import re
 from dataclasses import dataclass, field
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Optional, Pattern
 
 from mio.core.callbacks import CallbackGroup
 from mio.rooms.contents.messages import Notice, Textual
@@ -21,6 +22,8 @@ from .module import MarkovModule, MarkovRoom
 if TYPE_CHECKING:
     from .client import MarkovClient
 
+log = logging.getLogger(__name__)
+
 
 @dataclass
 class Listener(CallbackGroup):
@@ -29,13 +32,32 @@ class Listener(CallbackGroup):
     rooms:     MarkovModule = field(init=False, repr=False)
     mentions:  List[str]    = field(default_factory=list)
 
+    _mention_patterns: List[Pattern] = field(
+        init=False, repr=False, default_factory=list,
+    )
+
+    # Display name the patterns were built from
+    _mention_name: Optional[str] = field(init=False, repr=False, default=None)
+
 
     def __post_init__(self):
-        self.rooms    = self.client.markov
+        self.rooms = self.client.markov
+        self._update_mentions()
+
+
+    def _update_mentions(self) -> None:
+        self._mention_name = self.client.profile.name
+
         self.mentions = [
             self.client.user_id,
             # self.client.user_id.localpart,
-            self.client.profile.name,
+            self._mention_name,
+        ]
+
+        # Compiled once here instead of going through re's cache per message
+        self._mention_patterns = [
+            re.compile(rf"(?i)^\s*{re.escape(mention)}\W")
+            for mention in self.mentions
         ]
 
 
@@ -45,16 +67,20 @@ class Listener(CallbackGroup):
         body        = event.content.stripped_body
         markov_room = self.rooms[room.id]
 
-        print(f"message: {event.sender}: {body}")
+        log.debug("message: %s: %s", event.sender, body)
 
         if self.client.user_id == event.sender:
             return
 
-        for mention in self.mentions:
-            regex = rf"^\s*(?i){re.escape(mention)}\W"
-            if re.match(regex, body):
-                body = "".join(re.split(regex, body)[1:])
-                return await RootCommand(body, room, event, markov_room)()
+        if self.client.profile.name != self._mention_name:
+            self._update_mentions()
+
+        for pattern in self._mention_patterns:
+            match = pattern.match(body)
+
+            if match:
+                argv = body[match.end():].split()
+                return await RootCommand(argv, room, event, markov_room)()
 
         await markov_room.register_sentence(body)
 
@@ -68,6 +94,9 @@ class Listener(CallbackGroup):
         self, room: Room, event: StateEvent[Member],
     ):
         if not event.content.absent and event.sender == self.client.user_id:
+            if room.id in self.rooms._data:
+                await self.rooms._data[room.id].flush()
+
             self.rooms._data[room.id] = await MarkovRoom(
                 self.client, id=room.id,
             ).load()
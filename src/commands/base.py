@@ -4,10 +4,10 @@
 # Date: 2021-04
 # Copyright (c) 2021 vslg & contributors
 
-from collections import Mapping
+from collections.abc import Mapping
 from dataclasses import dataclass, field
-from functools import wraps
-from typing import Any, Dict, Iterator, List, Type, Union
+from functools import lru_cache, wraps
+from typing import Any, ClassVar, Dict, Iterator, List, Tuple, Type, Union
 
 import docopt
 from mio.client import Client
@@ -16,9 +16,9 @@ from mio.rooms.contents.messages import Notice
 from mio.rooms.events import TimelineEvent
 from mio.rooms.room import Room
 from mio.rooms.user import RoomUser
-from mistune import markdown
 
 from ..module import MarkovRoom
+from .formatting import code_block, paragraph
 
 
 class DocoptExit(Exception):
@@ -31,17 +31,79 @@ class DocoptExit(Exception):
 docopt.DocoptExit = DocoptExit
 
 
+class DocoptParser:
+    """docopt.docopt() split in two halves.
+
+    The usage grammar of a docstring is parsed once, when the parser is
+    created, and parse() only has to match an argv against it.
+    """
+
+    def __init__(self, doc: str, options_first: bool = False):
+        self.usage         = docopt.printable_usage(doc)
+        self.options       = docopt.parse_defaults(doc)
+        self.options_first = options_first
+        self.pattern       = docopt.parse_pattern(
+            docopt.formal_usage(self.usage), self.options,
+        )
+
+        pattern_options = set(self.pattern.flat(docopt.Option))
+
+        for any_options in self.pattern.flat(docopt.AnyOptions):
+            doc_options          = docopt.parse_defaults(doc)
+            any_options.children = list(set(doc_options) - pattern_options)
+
+        self.pattern.fix()
+
+
+    def parse(self, argv: Union[str, List[str]]) -> Dict[str, Any]:
+        DocoptExit.usage = self.usage
+
+        argv = docopt.parse_argv(
+            docopt.TokenStream(argv, DocoptExit),
+            list(self.options),
+            self.options_first,
+        )
+
+        matched, left, collected = self.pattern.match(argv)
+
+        if not matched or left:
+            raise DocoptExit()
+
+        # Default list values belong to the shared pattern, hand out copies
+        return {
+            a.name: list(a.value) if isinstance(a.value, list) else a.value
+            for a in self.pattern.flat() + collected
+        }
+
+
+@lru_cache(maxsize=None)
+def get_parser(doc: str) -> DocoptParser:
+    return DocoptParser(doc, options_first=True)
+
+
+@lru_cache(maxsize=None)
+def render_help(doc: str, usage_only: bool) -> Tuple[str, str]:
+    """Returns the help code block for doc as (markdown, HTML)."""
+
+    # Get rid of extra indentation
+    doc  = doc.replace("\n    ", "\n").strip()
+    body = docopt.printable_usage(doc) if usage_only else doc
+
+    return f"```\n{body}\n```", code_block(body)
+
+
 class Command(Mapping[str, Type["Command"]]):
     """A Command can be a standalone command or a command with subcommands.
 
     The command's behavior should be defined in Command.__call__()
 
-    If it holds any subcommands, they should be added to _data and _aliases.
+    If it holds any subcommands, they should be added to _data and _lookup.
     """
 
     # These fields are only for subcommands
-    _data:    Mapping[str, Type["Command"]] = {}
-    _aliases: Mapping[str, Type["Command"]] = {}
+    # _data is keyed by name, _lookup by both names and aliases
+    _data:   Mapping[str, Type["Command"]] = {}
+    _lookup: Mapping[str, Type["Command"]] = {}
 
     # Actual command info
     name:    str       = ""
@@ -62,10 +124,11 @@ class Command(Mapping[str, Type["Command"]]):
 
     @classmethod
     def add(cls, command):
-        cls._data[command.name] = command
+        cls._data[command.name]   = command
+        cls._lookup[command.name] = command
 
         for alias in command.aliases:
-            cls._aliases[alias] = command
+            cls._lookup[alias] = command
 
         return command
 
@@ -91,40 +154,61 @@ class MarkovCommand(Command):
 
     admin: bool = False
 
+    # __doc__ plus the generated "Commands" and "Aliases" sections
+    _full_doc: ClassVar[str] = ""
+
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._update_doc()
+
+
+    @classmethod
+    def _update_doc(cls) -> None:
+        """Builds _full_doc from __doc__, subcommands and aliases.
+
+        Runs when a class is defined and whenever its subcommands change, so
+        commands don't have to redo the formatting on every invocation.
+        """
+
+        doc = cls.__doc__ or ""
 
-    def __post_init__(self):
         # If we have subcommands, add a "Commands" section to __doc__
-        if self._data:
-            user_commands  = filter(lambda f: not f.admin, self._data.values())
-            admin_commands = filter(lambda f: f.admin, self._data.values())
+        if cls._data:
+            # kind -> [(name, description)], widest name of that kind
+            cmds:  Dict[str, List[Tuple[str, str]]] = {"User": [], "Admin": []}
+            width: Dict[str, int]                   = {"User": 0, "Admin": 0}
+
+            for cmd in cls._data.values():
+                kind = "Admin" if cmd.admin else "User"
+                name = f"    {cmd.name},{','.join(cmd.aliases)}"
 
-            for (kind, commands) in [
-                ("User", user_commands), ("Admin", admin_commands),
-            ]:
-                self.__doc__ += f"\n{kind} commands:\n"
+                cmds[kind].append((name, cmd.__doc__.split("\n", 1)[0]))
+                width[kind] = max(width[kind], len(name))
 
-                cmds = [(
-                    "    %s,%s" % (cmd.name, ",".join(cmd.aliases)),
-                    cmd.__doc__.split("\n")[0],
-                ) for cmd in commands]
+            for kind, lines in cmds.items():
+                # Subcommands are registered one at a time
+                if not lines:
+                    continue
 
                 # Alignment is always good
-                offset = max(map(lambda f: len(f[0]), cmds)) + 2
+                offset = width[kind] + 2
 
-                for name, desc in cmds:
-                    self.__doc__ += f"    %-{offset}s{desc}\n" % name
+                doc += f"\n{kind} commands:\n"
+                doc += "".join(
+                    f"    {name:<{offset}}{desc}\n" for name, desc in lines
+                )
 
         # If we have aliases, add them to "Aliases" section of __doc__
-        if self.aliases:
-            self.__doc__ += f"\nAliases:\n{' '*8}{', '.join(self.aliases)}"
+        if cls.aliases:
+            doc += f"\nAliases:\n{' '*8}{', '.join(cls.aliases)}"
+
+        cls._full_doc = doc
+
 
+    def __post_init__(self):
         try:
-            self.args = docopt.docopt(
-                self.__doc__,
-                options_first = True,
-                argv          = self.argv,
-                help          = False,
-            )
+            self.args = get_parser(self._full_doc).parse(self.argv)
         except DocoptExit:
             self.args = None
 
@@ -143,9 +227,7 @@ class MarkovCommand(Command):
         try:
             cmd_name = self.args.get("<command>", None)
             cmd_args = self.args.get("<args>", []) or []
-
-            aliased_cmd = self._aliases.get(cmd_name, None)
-            cmd         = aliased_cmd or self._data.get(cmd_name, None)
+            cmd      = self._lookup.get(cmd_name, None)
 
             if not cmd:
                 return await self.help("Invalid command")
@@ -156,23 +238,15 @@ class MarkovCommand(Command):
 
 
     async def help(self, extra_msg: str = "", usage_only: bool = True) -> None:
-        body = ""
+        body, html = render_help(self._full_doc, usage_only)
 
+        # Only the message in front of the usage needs rendering every time
         if extra_msg:
-            body += f"{extra_msg}\n\n"
-
-        # Get rid of extra indentation
-        doc = getattr(self, "__doc__", "").replace("\n    ", "\n").strip()
-
-        body += "```\n"
-        if usage_only:
-            body += docopt.printable_usage(doc)
-        else:
-            body += doc
-        body += "\n```"
+            body = f"{extra_msg}\n\n{body}"
+            html = paragraph(extra_msg) + html
 
         message                = Notice(body)
-        message.formatted_body = markdown(body)
+        message.formatted_body = html
         message.format         = "org.matrix.custom.html"
 
         await self.room.timeline.send(message)
@@ -186,9 +260,9 @@ class MarkovCommand(Command):
         for running this command and display help if solicited.
         """
 
-        # We need to clear _data and _aliases because they're inherited
-        command._data    = {}
-        command._aliases = {}
+        # We need to clear _data and _lookup because they're inherited
+        command._data   = {}
+        command._lookup = {}
 
         @super().add
         @wraps(command, updated=())
@@ -216,4 +290,6 @@ class MarkovCommand(Command):
                 return await super().__call__()
 
 
+        Wrapper._update_doc()
+        cls._update_doc()
         return Wrapper
@@ -0,0 +1,30 @@
+# File: formatting.py
+# Author: matrix-markov contributors
+# Brief: HTML for the few message shapes commands send
+# Date: 2026-10
+# Copyright (c) 2026 vslg & contributors
+
+from html import escape
+from typing import Any, Iterable, Sequence
+
+
+def paragraph(text: str) -> str:
+    return f"<p>{escape(text)}</p>\n"
+
+
+def code_block(text: str) -> str:
+    return f"<pre><code>{escape(text)}\n</code></pre>\n"
+
+
+def table(header: Sequence[str], rows: Iterable[Sequence[Any]]) -> str:
+    head = "".join(f"<th>{escape(str(cell))}</th>" for cell in header)
+    cells = (
+        "".join(f"<td>{escape(str(cell))}</td>" for cell in row)
+        for row in rows
+    )
+    body  = "".join(f"<tr>{row}</tr>\n" for row in cells)
+
+    return (
+        f"<table>\n<thead>\n<tr>{head}</tr>\n</thead>\n"
+        f"<tbody>\n{body}</tbody>\n</table>\n"
+    )
@@ -8,9 +8,19 @@ from contextlib import suppress
 from typing import List
 
 from mio.rooms.contents.messages import Notice
-from mistune import markdown
 
+from ..module import SENTENCE_START
 from .base import MarkovCommand
+from .formatting import table
+
+STATS_COLUMNS = ("Word 1", "Word 2", "Count")
+STATS_HEADER  = (
+    " | ".join(STATS_COLUMNS) + "\n" +
+    " | ".join("---" for _ in STATS_COLUMNS) + "\n"
+)
+
+# Shown for SENTENCE_START, can't be a learned word as "(" separates words
+SENTENCE_START_LABEL = "(start)"
 
 
 class RootCommand(MarkovCommand):
@@ -55,9 +65,9 @@ class GenerateCommand(MarkovCommand):
 
 
     async def __call__(self):
-        count         = int(self.args.pop("--count"))
+        count         = int(self.args["--count"])
         count         = max(min(count, 100), 2)
-        starting_word = self.args.pop("<starting_word>") or None
+        starting_word = self.args["<starting_word>"] or None
         text          = await self.markov_room.generate(count, starting_word)
 
         await self.room.timeline.send(Notice(text))
@@ -85,11 +95,11 @@ class FrequencyCommand(MarkovCommand):
 
     async def __call__(self):
         try:
-            number                = float(self.args.pop("<value>").rstrip("%"))
+            number                = float(self.args["<value>"].rstrip("%"))
             number                = max(min(number, 100.0), 0.0)
             self.markov_room.freq = number / 100
 
-            await self.markov_room.save()
+            self.markov_room.schedule_save()
             await self.room.timeline.send(
                 Notice("Frequency is now %.0f%%" % number))
         except (ValueError, KeyError):
@@ -119,21 +129,35 @@ class StatsCommand(MarkovCommand):
 
 
     async def __call__(self):
-        count = int(self.args.pop("<count>") or 10)
+        count = int(self.args["<count>"] or 10)
         count = max(min(count, 30), 1)
+        total = self.markov_room.pair_count
+        top   = [
+            (SENTENCE_START_LABEL if word1 == SENTENCE_START else word1,
+             word2, times)
+            for (word1, word2), times in self.markov_room.top_pairs(count)
+        ]
+
+        rows = "\n".join(
+            f"{word1:<20} | {word2:<20} | {times:<5}"
+            for word1, word2, times in top
+        )
+
+        reply = (
+            f"Total learned pairs: **{total}**\n\n"
+            f"Top **{count}** pairs:\n\n"
+            f"{STATS_HEADER}{rows}"
+        )
 
-        reply  = f"Total learned pairs: **{len(self.markov_room.pairs)}**\n\n"
-        reply += f"Top **{count}** pairs:\n\n"
-        reply += "Word 1 | Word 2 | Count\n"
-        reply += "--- | --- | ---\n"
-        reply += "\n".join(
-            "%-20s | %-20s | %-5s" % (i[0][0], i[0][1], i[1])
-            for i in self.markov_room.pairs.most_common(count)
+        html = (
+            f"<p>Total learned pairs: <strong>{total}</strong></p>\n"
+            f"<p>Top <strong>{count}</strong> pairs:</p>\n" +
+            table(STATS_COLUMNS, top)
         )
 
         message                = Notice(reply)
         message.format         = "org.matrix.custom.html"
-        message.formatted_body = markdown(reply)
+        message.formatted_body = html
 
         return await self.room.timeline.send(message)
 
@@ -163,9 +187,9 @@ class DeleteCommand(MarkovCommand):
 
 
     async def __call__(self):
-        pairs = self.args.pop("<word>")
+        pairs = self.args["<word>"]
 
-        if self.args.pop("--pair"):
+        if self.args["--pair"]:
             return await self.remove_pairs(pairs)
 
         await self.remove_words(pairs)
@@ -173,29 +197,29 @@ class DeleteCommand(MarkovCommand):
 
     async def remove_pairs(self, pairs) -> None:
         deleted = 0
-        to_remove = zip(pairs[::1], pairs[1::2])
+        words   = iter(pairs)
 
-        for pair in to_remove:
+        # Same iterator twice: consecutive words make up a pair
+        for pair in zip(words, words):
             with suppress(KeyError):
-                del self.markov_room.pairs[pair]
+                self.markov_room.remove_pair(pair)
                 deleted += 1
 
+        if deleted:
+            self.markov_room.schedule_save()
+
         return await self.room.timeline.send(
             Notice(f"Removed {deleted} pairs"),
         )
 
 
     async def remove_words(self, words) -> None:
-        to_remove = []
-
-        for pair in self.markov_room.pairs.keys():
-            if (pair[0] in words or pair[1] in words):
-                to_remove.append(pair)
+        to_remove = self.markov_room.pairs_with_words(words)
 
         for pair in to_remove:
-            del self.markov_room.pairs[pair]
+            self.markov_room.remove_pair(pair)
 
-        await self.markov_room.save()
+        self.markov_room.schedule_save()
 
         body  = f"Removed {len(to_remove)} pairs containing "
         body += "'"
@@ -233,8 +257,8 @@ class WhitelistCommand(MarkovCommand):
 
 
     async def __call__(self):
-        add, dele = self.args.pop("add"), self.args.pop("del")
-        user_str = self.args.pop("<user>") or ""
+        add, dele = self.args["add"], self.args["del"]
+        user_str = self.args["<user>"] or ""
         user = self.room.state.members.get(user_str.lower(), None)
 
         if (add or dele) and not user:
@@ -244,13 +268,13 @@ class WhitelistCommand(MarkovCommand):
 
         if add:
             self.markov_room.whitelist.add(user.user_id)
-            await self.markov_room.save()
+            self.markov_room.schedule_save()
             return await self.room.timeline.send(
                 Notice(f"Added {user.user_id} to whitelist"),
             )
         elif dele:
             self.markov_room.whitelist.discard(user.user_id)
-            await self.markov_room.save()
+            self.markov_room.schedule_save()
             return await self.room.timeline.send(
                 Notice(f"Removed {user.user_id} from whitelist"),
             )
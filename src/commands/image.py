@@ -4,13 +4,13 @@
 # Date: 2021-07
 # Copyright (c) 2021 vslg
 
-from asyncio import ensure_future
+from asyncio import ensure_future, get_running_loop
 from io import BytesIO
+from pathlib import Path
 from typing import List
 
 from mio.media.store import MediaStore
 from mio.rooms.contents.messages import Image, Notice
-from wand.image import Image as WImage
 
 from .base import MarkovCommand
 from .general import RootCommand
@@ -60,7 +60,7 @@ class SwirlCommand(MarkovCommand):
 
 
     async def download_and_send(self, image: Image) -> None:
-        angle = int(self.args.pop("<angle>") or 120)
+        angle = int(self.args["<angle>"] or 120)
 
         try:
             await self.client.media.download(image.mxc)
@@ -73,12 +73,23 @@ class SwirlCommand(MarkovCommand):
         store: MediaStore = self.client.media
         image_path        = await store._mxc_path(image.mxc).resolve()
 
+        # ImageMagick work is blocking, keep it off the event loop
+        data  = await get_running_loop().run_in_executor(
+            None, self.swirl, Path(image_path), angle,
+        )
+        media = await Image.from_data(self.client, BytesIO(data))
+        await self.room.timeline.send(media)
+
+
+    @staticmethod
+    def swirl(image_path: Path, angle: int) -> bytes:
+        # Loads ImageMagick, only pay for it when an image is swirled
+        from wand.image import Image as WImage
+
         with WImage() as img:
-            with WImage(filename=image_path) as src_img:
+            with WImage(filename=str(image_path)) as src_img:
                 for frame in src_img.sequence:
                     frame.swirl(degree=angle)
                     img.sequence.append(frame)
 
-            blob  = BytesIO(img.make_blob())
-            media = await Image.from_data(self.client, blob)
-            await self.room.timeline.send(media)
+            return img.make_blob()
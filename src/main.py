@@ -44,7 +44,10 @@ async def main():
 
     client.rooms.callback_groups.append(Listener(client))
 
-    await client.sync.loop()
+    try:
+        await client.sync.loop()
+    finally:
+        await client.markov.flush()
 
 
 if __name__ == "__main__":
@@ -4,10 +4,19 @@
 # Date: 2021-04
 # Copyright (c) 2021 vslg & contributors
 
+import asyncio
+import json
+import logging
 import random
 import re
+from array import array
+from bisect import bisect
 from dataclasses import dataclass, field
-from typing import Counter, Dict, Optional, Set, Tuple
+from heapq import nlargest
+from itertools import accumulate
+from operator import itemgetter
+from typing import (Counter, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple)
 
 from aiopath import AsyncPath
 from mio.core.data import IndexableMap, Runtime
@@ -15,15 +24,85 @@ from mio.core.files import decode_name, encode_name
 from mio.core.ids import RoomId, UserId
 from mio.module import JSONClientModule
 
+log = logging.getLogger(__name__)
+
+# What separates the words of a learned sentence
+WORD_SEPARATOR = re.compile(r"(?![',.\!\?:\-\/\\;\=\@])[\W_]+")
+
+# Prefix of the first word of a sentence
+SENTENCE_START = ""
+
+# Seconds to wait for more changes before writing a room to disk
+SAVE_DELAY = 5.0
+
+# Compact a room's journal into its JSON file past this many journaled pairs
+JOURNAL_MAX_PAIRS = 10_000
+
+# How many of the most common pairs MarkovRoom keeps track of
+TOP_PAIRS_MAX = 30
+
+# (prefix, word)
+Pair = Tuple[str, str]
+
+# Words that can follow a prefix and their cumulative weights
+WordChoices = Tuple[List[str], array]
+
 
 @dataclass
 class MarkovRoom(JSONClientModule):
     id: RoomId
 
-    whitelist: Set[UserId]                    = field(default_factory=set)
-    freq:      float                          = field(default=0.0)
+    whitelist: Set[UserId]             = field(default_factory=set)
+    freq:      float                   = field(default=0.0)
+    chain:     Dict[str, Counter[str]] = field(default_factory=dict)
+
+    # Which journal file goes with this snapshot, bumped on every compaction
+    journal_generation: int = field(default=0)
+
+    # Flat format used before chain, only read to convert older files
     pairs: Counter[Tuple[Optional[str], str]] = field(default_factory=Counter)
 
+    # word -> every pair containing it, so deleting words needs no full scan
+    _word_index: Runtime[Dict[str, Set[Pair]]] = field(
+        init=False, repr=False, default_factory=dict,
+    )
+
+    # The TOP_PAIRS_MAX most common pairs, rebuilt from chain when stale
+    _top_pairs: Runtime[Dict[Pair, int]] = field(
+        init=False, repr=False, default_factory=dict,
+    )
+    _top_stale: Runtime[bool] = field(init=False, repr=False, default=True)
+
+    # Least common pair of the top and its count, a pair counted no more
+    # than that can't enter a full top
+    _top_lowest: Runtime[Optional[Pair]] = field(
+        init=False, repr=False, default=None,
+    )
+    _top_floor: Runtime[int] = field(init=False, repr=False, default=0)
+
+    # prefix -> (words, cumulative weights) that generate() samples from,
+    # built per prefix when first needed
+    _choices: Runtime[Dict[str, WordChoices]] = field(
+        init=False, repr=False, default_factory=dict,
+    )
+
+    # Learned pairs are appended to a journal and only written to the JSON
+    # file on compaction, which is needed for any other kind of change
+    _unjournaled: Runtime[List[Pair]] = field(
+        init=False, repr=False, default_factory=list,
+    )
+    _journal_size: Runtime[int] = field(init=False, repr=False, default=0)
+    _snapshot_due: Runtime[bool] = field(
+        init=False, repr=False, default=False,
+    )
+
+    _save_task: Runtime[Optional[asyncio.Future]] = field(
+        init=False, repr=False, default=None,
+    )
+    _save_lock: Runtime[asyncio.Lock] = field(
+        init=False, repr=False, default_factory=asyncio.Lock,
+    )
+
 
     @property
     def path(self) -> AsyncPath:
@@ -31,19 +110,126 @@ class MarkovRoom(JSONClientModule):
         return self.client.path.parent / "markov" / (room_id + ".json")
 
 
+    @property
+    def journal_path(self) -> AsyncPath:
+        return self._journal_path(self.journal_generation)
+
+
+    @property
+    def pair_count(self) -> int:
+        return sum(map(len, self.chain.values()))
+
+
+    async def load(self) -> "MarkovRoom":
+        room = await super().load()
+        room._word_index.clear()
+        room._choices.clear()
+        room._top_stale = True
+
+        room._unjournaled.clear()
+        room._journal_size = 0
+
+        # Left behind if we stopped right after the last compaction's save
+        previous = room._journal_path(room.journal_generation - 1)
+        await previous.unlink(missing_ok=True)
+
+        if await room.journal_path.exists():
+            for line in (await room.journal_path.read_text()).splitlines():
+                # A crash can leave a truncated last line, compact instead of
+                # appending new pairs right after it
+                try:
+                    prefix, word = json.loads(line)
+                except (ValueError, TypeError):
+                    room.schedule_save()
+                    continue
+
+                room.chain.setdefault(prefix, Counter())[word] += 1
+                room._journal_size += 1
+
+        if room.pairs:
+            for (prefix, word), count in room.pairs.items():
+                prefix = prefix or SENTENCE_START
+                room.chain.setdefault(prefix, Counter())[word] += count
+
+            room.pairs.clear()
+            room.schedule_save()
+
+        for pair, _ in room._iter_pairs():
+            room._index_pair(pair)
+
+        return room
+
+
     async def register_sentence(self, sentence: str) -> None:
-        words = re.split(r"(?![',.\!\?:\-\/\\;\=\@])[\W_]+", sentence)
-        words = [i for i in words if i != ""]
+        words = list(filter(None, WORD_SEPARATOR.split(sentence)))
 
         if not words:
             return
 
-        await self._register_pair((None, words[0]))
+        # Don't let pairs slip in while compaction is writing the JSON file
+        async with self._save_lock:
+            await self._register_pair((SENTENCE_START, words[0]))
+
+            for pair in zip(words[:-1], words[1:]):
+                await self._register_pair(pair)
 
-        for pair in zip(words[:-1], words[1:]):
-            await self._register_pair(pair)
+        self.schedule_save(snapshot=False)
 
-        await self.save()
+
+    def schedule_save(self, snapshot: bool = True) -> None:
+        """Saves this room after SAVE_DELAY, batching later changes.
+
+        If snapshot is False, only newly learned pairs need saving and they
+        are appended to the journal instead of rewriting the JSON file.
+        """
+
+        self._snapshot_due = self._snapshot_due or snapshot
+
+        if not self._save_task:
+            self._save_task = asyncio.ensure_future(self._delayed_save())
+
+
+    async def flush(self) -> None:
+        """Immediately saves this room if it has unsaved changes.
+
+        Waits for any save already writing to finish first.
+        """
+
+        async with self._save_lock:
+            if self._save_task:
+                self._save_task.cancel()
+                self._save_task = None
+
+            if self._snapshot_due or self._unjournaled:
+                await self.compact()
+
+
+    async def compact(self) -> None:
+        """Writes the whole room to its JSON file and drops the journal.
+
+        The file written points to the next journal generation, so the old
+        journal is never replayed on top of it, even if we stop before it
+        is deleted.
+        """
+
+        journal            = self.journal_path
+        pairs, size        = self._unjournaled, self._journal_size
+        self._snapshot_due = False
+        self._unjournaled  = []
+        self._journal_size = 0
+
+        self.journal_generation += 1
+
+        try:
+            await self.save()
+        except BaseException:
+            self.journal_generation -= 1
+            self._snapshot_due      = True
+            self._unjournaled       = pairs + self._unjournaled
+            self._journal_size      = size
+            raise
+
+        await journal.unlink(missing_ok=True)
 
 
     async def generate(
@@ -55,38 +241,193 @@ class MarkovRoom(JSONClientModule):
 
         final_sentence = [starting_word] if starting_word else [""]
 
-        has_starting_word = False
-
-        for k in self.pairs.keys():
-            if k[0] == starting_word:
-                has_starting_word = True
-                break
-
-        if not has_starting_word:
-            starting_word = None
+        if starting_word not in self.chain:
+            starting_word = SENTENCE_START
 
         for _ in range(word_count):
-            words_and_weights = {
-                k[1]: v for k, v in self.pairs.items() if k[0] == starting_word
-            }
+            choices = self._next_words(starting_word)
 
-            words   = list(words_and_weights.keys())
-            weights = list(words_and_weights.values())
-
-            if not words:
-                starting_word = None
+            if not choices:
+                starting_word = SENTENCE_START
                 final_sentence[-1] += "."
                 continue
 
-            starting_word   = random.choices(words, weights)[0]
+            # What random.choices does for k=1, minus its call overhead
+            words, cum_weights = choices
+            index              = bisect(
+                cum_weights, random.random() * cum_weights[-1],
+            )
+
+            starting_word   = words[index]
             final_sentence += [starting_word]
 
         return " ".join(final_sentence)
 
 
-    async def _register_pair(self, pair: Tuple[Optional[str], str]) -> None:
-        print(f"Registered pair: {pair}")
-        self.pairs[pair] += 1
+    async def _register_pair(self, pair: Pair) -> None:
+        prefix, word = pair
+        self.chain.setdefault(prefix, Counter())[word] += 1
+        self._unjournaled.append(pair)
+        self._index_pair(pair)
+
+        if not self._top_stale:
+            self._update_top_pairs(pair)
+
+
+    def top_pairs(self, count: int) -> List[Tuple[Pair, int]]:
+        if count > TOP_PAIRS_MAX:
+            return nlargest(count, self._iter_pairs(), key=itemgetter(1))
+
+        if self._top_stale:
+            top = nlargest(
+                TOP_PAIRS_MAX, self._iter_pairs(), key=itemgetter(1),
+            )
+            self._top_pairs = dict(top)
+            self._top_stale = False
+            self._update_top_floor()
+
+        top = sorted(self._top_pairs.items(), key=itemgetter(1), reverse=True)
+        return top[:count]
+
+
+    def pairs_with_words(self, words: Iterable[str]) -> Set[Pair]:
+        found: Set[Pair] = set()
+
+        for word in set(words):
+            found.update(self._word_index.get(word, ()))
+
+        return found
+
+
+    def remove_pair(self, pair: Pair) -> None:
+        prefix, follower = pair
+        followers        = self.chain[prefix]
+
+        # Counter's del doesn't raise for missing keys
+        if follower not in followers:
+            raise KeyError(pair)
+
+        del followers[follower]
+
+        if not followers:
+            del self.chain[prefix]
+
+        # Whatever pair should take its place is unknown, rebuild on next use
+        if pair in self._top_pairs:
+            self._top_stale = True
+
+        self._choices.pop(prefix, None)
+
+        for word in set(pair):
+            pairs = self._word_index.get(word)
+
+            if pairs is not None:
+                pairs.discard(pair)
+
+                if not pairs:
+                    del self._word_index[word]
+
+
+    def _iter_pairs(self) -> Iterator[Tuple[Pair, int]]:
+        for prefix, followers in self.chain.items():
+            for word, count in followers.items():
+                yield (prefix, word), count
+
+
+    def _next_words(self, prefix: str) -> Optional[WordChoices]:
+        choices = self._choices.get(prefix)
+
+        if choices is None and prefix in self.chain:
+            followers = self.chain[prefix]
+            weights   = accumulate(followers.values())
+            choices   = (list(followers), array("Q", weights))
+
+            self._choices[prefix] = choices
+
+        return choices
+
+
+    def _update_top_pairs(self, pair: Pair) -> None:
+        count = self.chain[pair[0]][pair[1]]
+        top   = self._top_pairs
+        full  = len(top) >= TOP_PAIRS_MAX
+
+        # Counts only grow by one here, so a pair already in the top is above
+        # the floor and only pair can enter it. This is the common case.
+        if full and count <= self._top_floor:
+            return
+
+        if pair in top:
+            top[pair] = count
+
+            if pair != self._top_lowest:
+                return
+        else:
+            if full:
+                del top[self._top_lowest]
+
+            top[pair] = count
+
+        self._update_top_floor()
+
+
+    def _update_top_floor(self) -> None:
+        top = self._top_pairs
+
+        self._top_lowest = min(top, key=top.__getitem__) if top else None
+        self._top_floor  = top[self._top_lowest] if top else 0
+
+
+    async def _delayed_save(self) -> None:
+        await asyncio.sleep(SAVE_DELAY)
+
+        # Changes made while saving will schedule another save
+        self._save_task = None
+
+        async with self._save_lock:
+            try:
+                await self._write()
+            except Exception:
+                log.exception("Saving room %s failed, retrying", self.id)
+
+                # A snapshot covers anything a failed journal write missed
+                self.schedule_save()
+
+
+    async def _write(self) -> None:
+        size = self._journal_size + len(self._unjournaled)
+
+        if self._snapshot_due or size > JOURNAL_MAX_PAIRS:
+            return await self.compact()
+
+        # flush() may have saved everything while we waited for the lock
+        if not self._unjournaled:
+            return
+
+        pairs, self._unjournaled = self._unjournaled, []
+        lines                    = "".join(
+            json.dumps(pair) + "\n" for pair in pairs
+        )
+
+        await self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+
+        async with self.journal_path.open("a") as file:
+            await file.write(lines)
+
+        self._journal_size += len(pairs)
+
+
+    def _journal_path(self, generation: int) -> AsyncPath:
+        room_id = encode_name(self.id)
+        return self.path.with_name(f"{room_id}.{generation}.journal")
+
+
+    def _index_pair(self, pair: Pair) -> None:
+        self._choices.pop(pair[0], None)
+
+        for word in pair:
+            if word != SENTENCE_START:
+                self._word_index.setdefault(word, set()).add(pair)
 
 
 @dataclass
@@ -99,8 +440,28 @@ class MarkovModule(JSONClientModule, IndexableMap[RoomId, MarkovRoom]):
 
 
     async def load(self) -> "MarkovModule":
-        async for room_dir in (self.client.path.parent / "rooms").glob("!*"):
-            id             = RoomId(decode_name(room_dir.name))
-            self._data[id] = await MarkovRoom(self.client, id=id).load()
-
+        rooms_dir = self.client.path.parent / "rooms"
+        ids       = [
+            RoomId(decode_name(room_dir.name))
+            async for room_dir in rooms_dir.glob("!*")
+        ]
+
+        # Rooms are independent, read their files concurrently
+        rooms = await asyncio.gather(
+            *(MarkovRoom(self.client, id=id).load() for id in ids),
+        )
+
+        self._data.update(zip(ids, rooms))
         return self
+
+
+    async def flush(self) -> None:
+        # One room failing to save must not keep the others from saving
+        rooms   = list(self._data.values())
+        results = await asyncio.gather(
+            *(room.flush() for room in rooms), return_exceptions=True,
+        )
+
+        for room, result in zip(rooms, results):
+            if isinstance(result, Exception):
+                log.error("Flushing room %s failed", room.id, exc_info=result)